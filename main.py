@@ -1,14 +1,31 @@
 import sqlite3
 import os
+import re
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
 import requests
+try:
+    import orjson
+except ImportError:  # orjson необязателен, используем стандартный json
+    orjson = None
+    import json
+try:
+    import xxhash
+except ImportError:  # xxhash необязателен, используем hashlib
+    xxhash = None
+    import hashlib
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import telebot
 from telebot import types
 from datetime import datetime
 import threading
-from functools import lru_cache
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Инициализация окружения
 load_dotenv()
@@ -28,9 +45,15 @@ def setup_logging():
     )
     file_handler.setFormatter(formatter)
 
+    # Форматирование и запись на диск выполняются в фоновом потоке слушателя
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
-    logger.addHandler(file_handler)
+    logger.addHandler(QueueHandler(log_queue))
     
     return logger
 
@@ -41,6 +64,20 @@ class DatabaseManager:
     _instance = None
     _lock = threading.Lock()
     
+    # PRAGMA-настройки, применяемые к каждому соединению
+    PRAGMAS = (
+        'PRAGMA busy_timeout = 5000',  # первым, чтобы остальные PRAGMA ждали блокировку
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA mmap_size = 268435456',
+        'PRAGMA cache_size = -20000',
+        'PRAGMA foreign_keys = ON',
+    )
+    
+    # Интервал фоновой очистки старых сообщений (секунды)
+    PURGE_INTERVAL = 3600
+    
     def __new__(cls):
         if cls._instance is None:
             with cls._lock:
@@ -50,19 +87,20 @@ class DatabaseManager:
         return cls._instance
     
     def _init_db(self):
-        self.connections = {}
+        self._local = threading.local()
+        self.connections = []
+        self._connections_lock = threading.Lock()
+        self._purge_timer = None
+        self._purge_lock = threading.Lock()
+        self._stopped = False
         self._setup_database()
+        self._schedule_purge(0)  # первая очистка сразу после запуска
     
     def _setup_database(self):
         """Инициализация структуры БД"""
-        conn = sqlite3.connect('dialog_history.db', check_same_thread=False)
+        conn = self._connect()
         cursor = conn.cursor()
         
-        # Оптимизация БД
-        cursor.execute('PRAGMA journal_mode = WAL')
-        cursor.execute('PRAGMA synchronous = NORMAL')
-        cursor.execute('PRAGMA cache_size = -10000')
-        
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -72,38 +110,79 @@ class DatabaseManager:
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )''')
         
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_id ON messages(chat_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON messages(timestamp)')
-        
+        # Покрывающий индекс для выборки истории чата без обращения к таблице
+        cursor.execute('DROP INDEX IF EXISTS idx_chat_id')
+        cursor.execute('DROP INDEX IF EXISTS idx_timestamp')
+        cursor.execute('DROP INDEX IF EXISTS idx_chat_ts')
         cursor.execute('''
-        CREATE TRIGGER IF NOT EXISTS cleanup_old_messages
-        AFTER INSERT ON messages
-        BEGIN
-            DELETE FROM messages 
-            WHERE timestamp < datetime('now', '-7 days');
-        END''')
+        CREATE INDEX IF NOT EXISTS idx_chat_history
+        ON messages(chat_id, id DESC, role, content)''')
+        
+        # Очистка старых сообщений выполняется фоновым потоком (см. _purge)
+        cursor.execute('DROP TRIGGER IF EXISTS cleanup_old_messages')
         
         cursor.execute('PRAGMA optimize')
-        conn.commit()
         conn.close()
     
+    def _schedule_purge(self, delay=None):
+        """Планирование следующей очистки старых сообщений"""
+        if delay is None:
+            delay = self.PURGE_INTERVAL
+        with self._purge_lock:
+            if self._stopped:
+                return
+            self._purge_timer = threading.Timer(delay, self._purge)
+            self._purge_timer.daemon = True
+            self._purge_timer.start()
+    
+    def _purge(self):
+        """Удаление сообщений старше 7 дней"""
+        conn = None
+        try:
+            conn = self._connect()
+            conn.execute("DELETE FROM messages WHERE timestamp < datetime('now', '-7 days')")
+            conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        except Exception as e:
+            logger.error(f"Ошибка очистки старых сообщений: {str(e)}", extra={'chat_id': 'SYSTEM'})
+        finally:
+            if conn is not None:
+                conn.close()
+            self._schedule_purge()
+    
+    def _connect(self):
+        """Новое соединение в режиме автокоммита с применёнными PRAGMA"""
+        # isolation_level=None: транзакции открываются только явным BEGIN
+        conn = sqlite3.connect(
+            'dialog_history.db',
+            check_same_thread=False,
+            isolation_level=None
+        )
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
     def get_connection(self):
         """Получение соединения для текущего потока"""
-        thread_id = threading.get_ident()
-        if thread_id not in self.connections:
-            conn = sqlite3.connect(
-                'dialog_history.db',
-                check_same_thread=False
-            )
-            conn.execute('PRAGMA foreign_keys = ON')
-            self.connections[thread_id] = conn
-        return self.connections[thread_id]
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            # Реестр нужен только для close_all; sqlite3.Connection не поддерживает weakref
+            with self._connections_lock:
+                self.connections.append(conn)
+        return conn
     
     def close_all(self):
         """Закрытие всех соединений"""
-        for conn in self.connections.values():
-            conn.close()
-        self.connections.clear()
+        with self._purge_lock:
+            self._stopped = True
+            if self._purge_timer is not None:
+                self._purge_timer.cancel()
+        with self._connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+        self._local = threading.local()
 
 # Инициализация менеджера БД
 db_manager = DatabaseManager()
@@ -118,95 +197,242 @@ except Exception as e:
 
 # Конфигурация YandexGPT API
 YC_API_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+YC_FOLDER_ID = os.getenv('YC_FOLDER_ID')
+MODEL_URI = f"gpt://{YC_FOLDER_ID}/yandexgpt"
 HEADERS = {
     "Authorization": f"Api-Key {os.getenv('YC_API_KEY')}",
-    "x-folder-id": os.getenv('YC_FOLDER_ID'),
+    "x-folder-id": YC_FOLDER_ID,
     "Content-Type": "application/json"
 }
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "text": "Ты - точный AI-ассистент. Отвечай кратко и по делу. Избегай вводных фраз."
+}
+# Неизменяемая часть тела запроса; на каждый вызов добавляются только messages
+BASE_PAYLOAD = {
+    "modelUri": MODEL_URI,
+    "completionOptions": {
+        "stream": False,
+        "temperature": 0.2,
+        "maxTokens": 400
+    }
+}
+
+# Общая HTTP-сессия: переиспользует TCP/TLS соединения между запросами
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    # Запрос completion не меняет состояния на сервере, поэтому POST можно повторять
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({"POST"})
+    )
+))
+
+UNWANTED_PHRASES = [
+    "как искусственный интеллект",
+    "я обученная модель",
+    "насколько я понимаю",
+    "вот развернутый ответ",
+    "как языковая модель"
+]
+_UNWANTED_RE = re.compile('|'.join(re.escape(p) for p in UNWANTED_PHRASES), re.IGNORECASE)
+
+def dumps_json(data) -> bytes:
+    """Сериализация тела запроса (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+def loads_json(content: bytes):
+    """Разбор тела ответа (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
 
 def filter_response(text: str) -> str:
     """Фильтрация ненужных фраз в ответах"""
-    unwanted_phrases = [
-        "как искусственный интеллект",
-        "я обученная модель",
-        "насколько я понимаю",
-        "вот развернутый ответ",
-        "как языковая модель"
-    ]
-    
-    for phrase in unwanted_phrases:
-        text = text.replace(phrase, "")
+    return _UNWANTED_RE.sub('', text).strip()
+
+# LRU-кеш ответов: chat_id -> OrderedDict(хеш запроса и контекста -> ответ)
+CACHE_SIZE_PER_CHAT = 64
+CACHE_HISTORY_TAIL = 3
+CACHE_MAX_CHATS = 2000
+_response_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def normalize_text(text: str) -> str:
+    """Нормализация текста для ключа кеша"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return ' '.join(text.split()).strip(' .,!?')
+
+def context_hash(prompt: str, history: list) -> int:
+    """Хеш нормализованного запроса и последних сообщений истории.
     
-    return text.strip()
+    Каждая часть записывается как role:длина:текст, поэтому разные контексты
+    (перенос текста между частями, перестановка ролей) не дают одинаковых байтов.
+    """
+    tail = history[-CACHE_HISTORY_TAIL:]
+    hasher = xxhash.xxh3_64() if xxhash is not None else hashlib.blake2b(digest_size=8)
+    hasher.update(f"{len(tail)};".encode('utf-8'))
+    for role, content in tail + [("user", normalize_text(prompt))]:
+        data = content.encode('utf-8')
+        hasher.update(f"{role}:{len(data)}:".encode('utf-8'))
+        hasher.update(data)
+    return int.from_bytes(hasher.digest(), 'big')
 
-@lru_cache(maxsize=500)
 def get_cached_response(chat_id: int, prompt: str) -> str:
-    """Кеширование ответов с учетом chat_id"""
-    return ask_yandex_gpt(prompt, chat_id)
+    """Кеширование ответов с учетом chat_id и контекста диалога.
+    
+    Ключ включает хвост истории, а каждый ответ API её дополняет (попадание в
+    кеш историю не меняет). Поэтому попадания случаются в основном при точном
+    повторе одного и того же обмена, а не при любом повторе вопроса, при этом
+    каждое сообщение платит чтением истории из БД и хешированием до проверки кеша.
+    """
+    history = get_dialog_history(chat_id)
+    key = context_hash(prompt, history)
+    with _cache_lock:
+        chat_cache = _response_cache.get(chat_id)
+        if chat_cache is not None and key in chat_cache:
+            _response_cache.move_to_end(chat_id)
+            chat_cache.move_to_end(key)
+            return chat_cache[key]
+    
+    response, ok = ask_yandex_gpt(prompt, chat_id, history)
+    if not ok:
+        return response  # Ошибки не кешируем, повторный запрос снова пойдёт в API
+    
+    with _cache_lock:
+        chat_cache = _response_cache.get(chat_id)
+        if chat_cache is None:
+            chat_cache = _response_cache[chat_id] = OrderedDict()
+            if len(_response_cache) > CACHE_MAX_CHATS:
+                _response_cache.popitem(last=False)
+        else:
+            _response_cache.move_to_end(chat_id)
+        chat_cache[key] = response
+        if len(chat_cache) > CACHE_SIZE_PER_CHAT:
+            chat_cache.popitem(last=False)
+    return response
+
+def clear_cached_responses(chat_id: int) -> None:
+    """Очистка кеша ответов для одного чата"""
+    with _cache_lock:
+        _response_cache.pop(chat_id, None)
 
 def get_dialog_history(chat_id: int, max_messages: int = 7) -> list:
     """Получение истории диалога"""
     conn = db_manager.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT role, content FROM messages 
-    WHERE chat_id = ? 
-    ORDER BY timestamp DESC 
-    LIMIT ?
-    ''', (chat_id, max_messages))
-    return cursor.fetchall()[::-1]
-
-def save_message(chat_id: int, role: str, content: str) -> None:
-    """Сохранение сообщения в историю"""
+    # Последние сообщения выбираются по убыванию id и отдаются в хронологическом порядке
+    return conn.execute('''
+    SELECT role, content FROM (
+        SELECT id, role, content FROM messages 
+        WHERE chat_id = ? 
+        ORDER BY id DESC 
+        LIMIT ?
+    ) ORDER BY id
+    ''', (chat_id, max_messages)).fetchall()
+
+def save_messages(chat_id: int, pairs: list) -> None:
+    """Сохранение пачки сообщений (role, content) одной транзакцией"""
     conn = db_manager.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-    INSERT INTO messages (chat_id, role, content) 
-    VALUES (?, ?, ?)
-    ''', (chat_id, role, content))
-    conn.commit()
-
-def ask_yandex_gpt(prompt: str, chat_id: int) -> str:
-    """Запрос к YandexGPT с историей диалога"""
-    history = get_dialog_history(chat_id)
-    
-    messages = [{
-        "role": "system",
-        "text": "Ты - точный AI-ассистент. Отвечай кратко и по делу. Избегай вводных фраз."
-    }]
-    
-    for role, content in history:
-        messages.append({"role": role, "text": content})
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany('''
+        INSERT INTO messages (chat_id, role, content) 
+        VALUES (?, ?, ?)
+        ''', [(chat_id, role, content) for role, content in pairs])
+        conn.execute('COMMIT')
+    except Exception:
+        # SQLite мог уже откатить транзакцию сам (SQLITE_FULL, IOERR и т.п.)
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+def ask_yandex_gpt(prompt: str, chat_id: int, history: list = None) -> tuple:
+    """Запрос к YandexGPT с историей диалога; возвращает (текст, успех)"""
+    if history is None:
+        history = get_dialog_history(chat_id)
     
+    messages = [SYSTEM_MESSAGE]
+    messages += [{"role": role, "text": content} for role, content in history]
     messages.append({"role": "user", "text": prompt})
     
-    data = {
-        "modelUri": f"gpt://{os.getenv('YC_FOLDER_ID')}/yandexgpt",
-        "completionOptions": {
-            "stream": False,
-            "temperature": 0.2,
-            "maxTokens": 400
-        },
-        "messages": messages
-    }
+    data = {**BASE_PAYLOAD, "messages": messages}
 
     try:
-        response = requests.post(YC_API_URL, json=data, headers=HEADERS, timeout=15)
+        response = SESSION.post(YC_API_URL, data=dumps_json(data), timeout=(3.05, 15))
         response.raise_for_status()
-        result = response.json()["result"]["alternatives"][0]["message"]["text"]
+        result = loads_json(response.content)["result"]["alternatives"][0]["message"]["text"]
         result = filter_response(result)
         
-        save_message(chat_id, "user", prompt)
-        save_message(chat_id, "assistant", result)
+        save_messages(chat_id, [("user", prompt), ("assistant", result)])
         
-        return result
+        return result, True
         
     except requests.exceptions.RequestException as e:
         logger.error(f"Ошибка запроса к YandexGPT: {str(e)}", extra={'chat_id': chat_id})
-        return "⚠️ Ошибка обработки запроса"
+        return "⚠️ Ошибка обработки запроса", False
     except Exception as e:
         logger.error(f"Неожиданная ошибка: {str(e)}", extra={'chat_id': chat_id})
-        return "⚠️ Системная ошибка"
+        return "⚠️ Системная ошибка", False
+
+# Приветствия, на которые отвечаем без обращения к API
+GREETINGS = frozenset({"привет", "здравствуй", "здравствуйте", "hi", "hello"})
+GREETING_REPLY = "Привет! Чем помочь?"
+
+# Готовые ответы на частые короткие вопросы (ключ - нормализованный текст)
+CANNED_RESPONSES = {
+    "как тебя зовут": "Я AI-ассистент.",
+    "кто ты": "Я AI-ассистент.",
+    "что ты умеешь": "Отвечаю на вопросы кратко и по делу. Просто напиши свой вопрос!",
+    "спасибо": "Пожалуйста!",
+}
+
+# Пул потоков для обработки сообщений. Задачи одного чата выполняются по очереди:
+# у каждого чата своя очередь, которую разбирает не более одного потока пула.
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+CHAT_QUEUE_SIZE = 5
+_chat_queues = {}
+_chat_queues_lock = threading.Lock()
+
+def _drain_chat(chat_id):
+    """Последовательное выполнение задач из очереди чата"""
+    while True:
+        with _chat_queues_lock:
+            func, message = _chat_queues[chat_id][0]
+        try:
+            func(message)
+        except Exception as e:
+            logger.error(f"Ошибка в обработчике: {str(e)}", extra={'chat_id': chat_id})
+        with _chat_queues_lock:
+            pending = _chat_queues[chat_id]
+            pending.popleft()
+            if not pending:
+                del _chat_queues[chat_id]
+                return
+
+def submit_for_chat(func, message) -> bool:
+    """Постановка задачи в очередь чата; False, если очередь чата переполнена"""
+    chat_id = message.chat.id
+    with _chat_queues_lock:
+        pending = _chat_queues.get(chat_id)
+        if pending is None:
+            _chat_queues[chat_id] = deque([(func, message)])
+            EXECUTOR.submit(_drain_chat, chat_id)
+            return True
+        if len(pending) >= CHAT_QUEUE_SIZE:
+            return False
+        pending.append((func, message))
+        return True
+
+def stop_workers():
+    """Завершение пула после обработки уже поставленных задач"""
+    EXECUTOR.shutdown(wait=True)
 
 # Обработчики команд
 @bot.message_handler(commands=['start', 'help'])
@@ -226,14 +452,19 @@ def send_welcome(message):
 
 @bot.message_handler(commands=['clear'])
 def clear_history(message):
+    # Очистка идёт через очередь чата, чтобы не пересечься с запросом к API,
+    # который ещё выполняется и затем записал бы ответ в историю и кеш
+    if not submit_for_chat(process_clear, message):
+        bot.reply_to(message, "⏳ Слишком много запросов. Попробуйте позже.")
+
+def process_clear(message):
+    """Удаление истории и кеша чата (в очереди чата)"""
     try:
         conn = db_manager.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM messages WHERE chat_id = ?', (message.chat.id,))
-        conn.commit()
-        get_cached_response.cache_clear()  # Очищаем кеш
+        conn.execute('DELETE FROM messages WHERE chat_id = ?', (message.chat.id,))
+        clear_cached_responses(message.chat.id)  # Очищаем кеш чата
         bot.reply_to(message, "🗑️ История диалога очищена!")
-        logger.info(f"История очищена для chat_id: {message.chat.id}")
+        logger.info("История очищена", extra={'chat_id': message.chat.id})
     except Exception as e:
         logger.error(f"Ошибка очистки истории: {str(e)}", extra={'chat_id': message.chat.id})
         bot.reply_to(message, "❌ Не удалось очистить историю")
@@ -242,13 +473,27 @@ def clear_history(message):
 def handle_message(message):
     try:
         # Проверка простых команд без API
-        lower_text = message.text.lower().strip()
-        if lower_text in ["привет", "здравствуй"]:
-            return bot.reply_to(message, "Привет! Чем помочь?")
+        normalized = normalize_text(message.text)
+        if normalized in GREETINGS:
+            return bot.reply_to(message, GREETING_REPLY)
+        if normalized in CANNED_RESPONSES:
+            return bot.reply_to(message, CANNED_RESPONSES[normalized])
             
         if len(message.text) > 500:
             return bot.reply_to(message, "⚠️ Сообщение слишком длинное. Максимум 500 символов.")
         
+        # Запрос к API выполняется в пуле, поток polling сразу освобождается
+        if not submit_for_chat(process_message, message):
+            logger.warning("Очередь чата переполнена", extra={'chat_id': message.chat.id})
+            bot.reply_to(message, "⏳ Слишком много запросов. Попробуйте позже.")
+        
+    except Exception as e:
+        logger.error(f"Ошибка обработки: {str(e)}", extra={'chat_id': message.chat.id})
+        bot.reply_to(message, "❌ Ошибка обработки. Попробуйте позже.")
+
+def process_message(message):
+    """Получение ответа и отправка его пользователю (в пуле потоков)"""
+    try:
         bot.send_chat_action(message.chat.id, 'typing')
         response = get_cached_response(message.chat.id, message.text[:300])  # Кешируем
         bot.reply_to(message, response)
@@ -267,5 +512,6 @@ if __name__ == '__main__':
     except Exception as e:
         logger.critical(f"Критическая ошибка: {str(e)}", extra={'chat_id': 'SYSTEM'})
     finally:
+        stop_workers()
         db_manager.close_all()
         logger.info("----- Ресурсы освобождены -----", extra={'chat_id': 'SYSTEM'})
\ No newline at end of file